@@ -1,10 +1,17 @@
 # type: ignore[*]
 from logging import getLogger, DEBUG
+import functools
+from html import unescape
+import re
 import typing
 
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+import lxml.html  # type: ignore[import]
+from lxml import etree  # type: ignore[import]
+from urllib.parse import urlencode
 
 from ..exceptions import *
 
@@ -15,6 +22,158 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:73.0) Gecko/20100101 Firefox/73.0"
 }
 
+# parser used by BeautifulSoup for every ENT login page
+PARSER = "lxml"
+# login pages are only ever searched for their forms and inputs
+STRAINER = SoupStrainer(["form", "input"])
+# the title is in the <head>, no need to look past the start of the page
+_TITLE_RE = re.compile(rb"<title[^>]*>([^<]+)</title>", re.IGNORECASE)
+
+_SAML_RESPONSE_XP = etree.XPath(
+    "//input[@name='SAMLResponse' or @name='RelayState'][@value]"
+)
+_SAML_REQUEST_XP = etree.XPath(
+    "//input[@name='SAMLRequest' or @name='RelayState'][@value]"
+)
+_FORM_ACTION_XP = etree.XPath("(//form)[1]/@action")
+# fast path for the SAML auto-submit page EduConnect answers with
+_SAML_RESPONSE_RE = re.compile(
+    rb'<input[^>]*\sname="(SAMLResponse|RelayState)"[^>]*\svalue="([^"]*)"',
+    re.IGNORECASE,
+)
+# only the first <form> tag is looked at, like _FORM_ACTION_XP
+_FORM_TAG_RE = re.compile(rb"<form\b[^>]*>", re.IGNORECASE)
+_ACTION_ATTR_RE = re.compile(rb'\saction="([^"]+)"', re.IGNORECASE)
+_NETLOC_RE = re.compile(r"^https?://([^/?#]+)", re.IGNORECASE)
+
+# retry single requests failing with a gateway error instead of making the
+# caller redo the whole login, the last response is returned if it still fails.
+# Read errors are not retried since the server may already have consumed the
+# credentials or single use ticket, and Retry-After is ignored so a maintenance
+# page fails the login instead of blocking it for hours.
+_RETRY = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "POST"]),
+    raise_on_status=False,
+    respect_retry_after_header=False,
+)
+# shared between all ENT sessions so connections to the same hosts are reused,
+# pool_connections is the number of hosts (ENTs, EduConnect...) kept alive
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=_RETRY)
+
+
+def _new_session() -> requests.Session:
+    """Create a session using the shared connection pool and ENT headers"""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("https://", _ADAPTER)
+    session.mount("http://", _ADAPTER)
+    return session
+
+
+def _header_encoding(response: requests.Response) -> typing.Optional[str]:
+    """Charset sent in the Content-Type header, None to let the parser sniff it"""
+    # only trust the charset the server actually sent, requests falls back to
+    # ISO-8859-1 for text/html, which would override the page's <meta> charset
+    if "charset" in response.headers.get("Content-Type", ""):
+        return response.encoding
+    return None
+
+
+def _parse(response: requests.Response) -> BeautifulSoup:
+    """Parse the forms and inputs of an ENT page"""
+    return BeautifulSoup(
+        response.content,
+        PARSER,
+        parse_only=STRAINER,
+        from_encoding=_header_encoding(response),
+    )
+
+
+def _parse_tree(response: requests.Response) -> typing.Optional[etree._Element]:
+    """Parse an ENT page into an lxml tree, None if the page is empty"""
+    parser = lxml.html.html_parser
+    encoding = _header_encoding(response)
+    if encoding:
+        try:
+            parser = lxml.html.HTMLParser(encoding=encoding)
+        except LookupError:
+            # charset libxml2 doesn't know, sniff it like without a header
+            pass
+    return etree.fromstring(response.content, parser)
+
+
+def _scrape_form_and_post(
+    session: requests.Session, url: str, form_attr: dict, username: str, password: str
+) -> requests.Response:
+    """
+    Fill in the login form found on the page and submit it
+
+    Parameters
+    ----------
+    session : requests.Session
+        session used for both requests
+    url : str
+        url of the page containing the form
+    form_attr : dict
+        attr to locate form
+    username : str
+        username
+    password : str
+        password
+
+    Returns
+    -------
+    response: requests.Response
+        the response to the form submission
+    """
+    response = session.get(url)
+
+    soup = _parse(response)
+    form = soup.find("form", form_attr)
+    if form is None:
+        raise ENTLoginError("Login form not found")
+    payload = {
+        input_["name"]: input_.get("value")
+        for input_ in form("input")
+        if input_.has_attr("name")
+    }
+    payload["username"] = username
+    payload["password"] = password
+
+    return session.post(response.url, data=payload)
+
+
+def _read_saml_response(
+    response: requests.Response,
+) -> typing.Tuple[typing.Optional[str], dict]:
+    """Form action and SAML inputs of the page returned by EduConnect"""
+    content = response.content
+    payload = {
+        name.decode(): unescape(value.decode())
+        for name, value in _SAML_RESPONSE_RE.findall(content)
+    }
+    form = _FORM_TAG_RE.search(content)
+    action = form and _ACTION_ATTR_RE.search(form.group())
+    # a RelayState the regex missed (other attribute order) means the page
+    # must go through lxml, or it would be silently dropped from the payload
+    relay_state = "RelayState" in payload or b"RelayState" not in content
+    if "SAMLResponse" in payload and relay_state and action:
+        return unescape(action.group(1).decode()), payload
+
+    # markup the regexes don't expect (or no SAML response at all)
+    tree = _parse_tree(response)
+    if tree is None:
+        return None, {}
+    payload = {
+        input_.get("name"): input_.get("value") for input_ in _SAML_RESPONSE_XP(tree)
+    }
+    action = _FORM_ACTION_XP(tree)
+    return (action[0] if action else None), payload
+
 
 @typing.no_type_check
 def _educonnect(
@@ -40,23 +199,16 @@ def _educonnect(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[EduConnect {url}] Logging in with {username}")
+    log.debug("[EduConnect %s] Logging in with %s", url, username)
 
     payload = {"j_username": username, "j_password": password, "_eventId_proceed": ""}
     response = session.post(url, headers=HEADERS, data=payload)
     # 2nd SAML Authentication
-    soup = BeautifulSoup(response.text, "html.parser")
-    input_SAMLResponse = soup.find("input", {"name": "SAMLResponse"})
-    if not input_SAMLResponse:
+    action, payload = _read_saml_response(response)
+    if "SAMLResponse" not in payload:
         return
 
-    payload = {"SAMLResponse": input_SAMLResponse["value"]}
-
-    input_relayState = soup.find("input", {"name": "RelayState"})
-    if input_relayState:
-        payload["RelayState"] = input_relayState["value"]
-
-    response = session.post(soup.find("form")["action"], headers=HEADERS, data=payload)
+    response = session.post(action, headers=HEADERS, data=payload)
     return response
 
 
@@ -83,19 +235,18 @@ def _cas_edu(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[ENT {url}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", url, username)
 
     # ENT Connection
-    session = requests.Session()
+    session = _new_session()
 
-    response = session.get(url, headers=HEADERS)
-    soup = BeautifulSoup(response.text, "html.parser")
+    response = session.get(url)
+    tree = _parse_tree(response)
     payload = {
-        "RelayState": soup.find("input", {"name": "RelayState"})["value"],
-        "SAMLRequest": soup.find("input", {"name": "SAMLRequest"})["value"],
+        input_.get("name"): input_.get("value") for input_ in _SAML_REQUEST_XP(tree)
     }
 
-    response = session.post(soup.find("form")["action"], data=payload, headers=HEADERS)
+    response = session.post(_FORM_ACTION_XP(tree)[0], data=payload)
 
     educonnect(response.url, session, username, password)
 
@@ -125,23 +276,21 @@ def _cas(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[ENT {url}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", url, username)
 
     # ENT Connection
-    session = requests.Session()
-    response = session.get(url, headers=HEADERS)
+    session = _new_session()
+    _scrape_form_and_post(
+        session, url, {"class": "cas__login-form"}, username, password
+    )
 
-    soup = BeautifulSoup(response.text, "html.parser")
-    form = soup.find("form", {"class": "cas__login-form"})
-    payload = {}
-    for input_ in form.findAll("input"):
-        payload[input_["name"]] = input_.get("value")
-    payload["username"] = username
-    payload["password"] = password
+    return session.cookies
 
-    session.post(response.url, data=payload, headers=HEADERS)
 
-    return session.cookies
+@functools.lru_cache(maxsize=256)
+def _open_ent_ng_edu_params(domain: str) -> str:
+    """Encoded query string of the EduConnect SSO request for an ENT domain"""
+    return urlencode({"providerId": f"{domain}/auth/saml/metadata/idp.xml"})
 
 
 def _open_ent_ng_edu(
@@ -167,25 +316,23 @@ def _open_ent_ng_edu(
     if not domain:
         raise ENTLoginError("Missing domain attribute")
 
-    log.debug(f"[ENT {domain}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", domain, username)
 
     # URL required
     ent_login_page = (
         "https://educonnect.education.gouv.fr/idp/profile/SAML2/Unsolicited/SSO"
     )
 
-    session = requests.Session()
-
-    params = {"providerId": f"{domain}/auth/saml/metadata/idp.xml"}
+    session = _new_session()
 
-    response = session.get(ent_login_page, params=params, headers=HEADERS)
+    response = session.get(ent_login_page, params=_open_ent_ng_edu_params(domain))
     response = educonnect(response.url, session, username, password)
 
     if not response:
         return open_ent_ng(response.url, username, password)
     else:
-        soup = BeautifulSoup(response.text, "html.parser")
-        if soup.find("title").get_text() == "Authentification":
+        title = _TITLE_RE.search(response.content, 0, 4096)
+        if title and title.group(1).strip() == b"Authentification":
             return open_ent_ng(response.url, username, password)
 
     return session.cookies
@@ -214,16 +361,30 @@ def _open_ent_ng(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[ENT {url}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", url, username)
 
     # ENT Connection
-    session = requests.Session()
+    session = _new_session()
 
     payload = {"email": username, "password": password}
-    response = session.post(url, headers=HEADERS, data=payload)
+    response = session.post(url, data=payload)
     return session.cookies
 
 
+@functools.lru_cache(maxsize=256)
+def _wayf_params(entityID: str, returnX: str) -> str:
+    """Encoded query string of the WAYF discovery request"""
+    return urlencode(
+        {
+            "entityID": entityID,
+            "returnX": returnX,
+            "returnIDParam": "entityID",
+            "action": "selection",
+            "origin": "https://_educonnect.education.gouv.fr/idp",
+        }
+    )
+
+
 def _wayf(
     username: str,
     password: str,
@@ -259,22 +420,14 @@ def _wayf(
     if not returnX:
         returnX = f"{domain}/Shibboleth.sso/Login"
 
-    log.debug(f"[ENT {domain}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", domain, username)
 
     ent_login_page = f"{domain}/discovery/WAYF"
 
     # ENT Connection
-    session = requests.Session()
+    session = _new_session()
 
-    params = {
-        "entityID": entityID,
-        "returnX": returnX,
-        "returnIDParam": "entityID",
-        "action": "selection",
-        "origin": "https://_educonnect.education.gouv.fr/idp",
-    }
-
-    response = session.get(ent_login_page, params=params, headers=HEADERS)
+    response = session.get(ent_login_page, params=_wayf_params(entityID, returnX))
     _educonnect(response.url, session, username, password)
 
     return session.cookies
@@ -303,32 +456,28 @@ def _oze_ent(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[ENT {url}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", url, username)
 
-    # ENT Connection
-    session = requests.Session()
-    response = session.get(url, headers=HEADERS)
-
-    domain = urlparse(url).netloc
+    netloc = _NETLOC_RE.match(url)
+    if not netloc:
+        raise ENTLoginError("Invalid url attribute")
+    domain = netloc.group(1)
 
     if not domain in username:
         username = f"{username}@{domain}"
 
-    soup = BeautifulSoup(response.text, "html.parser")
-    form = soup.find("form", {"id": "auth_form"})
-    payload = {}
-    for input_ in form.findAll("input"):
-        payload[input_["name"]] = input_.get("value")
-    payload["username"] = username
-    payload["password"] = password
-
-    session.post(response.url, data=payload, headers=HEADERS)
+    # ENT Connection
+    session = _new_session()
+    _scrape_form_and_post(session, url, {"id": "auth_form"}, username, password)
 
     return session.cookies
 
 
 def _simple_auth(
-    username: str, password: str, url: str = "", form_attr: dict = {}
+    username: str,
+    password: str,
+    url: str = "",
+    form_attr: typing.Optional[dict] = None,
 ) -> requests.cookies.RequestsCookieJar:
     """
     Generic function for ENT with simple login form
@@ -341,8 +490,8 @@ def _simple_auth(
         password
     url: str
         url of the ent login page
-    form_attr: dict
-        attr to locate form
+    form_attr: dict, optional
+        attr to locate form, the first form of the page is used if not given
 
     Returns
     -------
@@ -352,20 +501,10 @@ def _simple_auth(
     if not url:
         raise ENTLoginError("Missing url attribute")
 
-    log.debug(f"[ENT {url}] Logging in with {username}")
+    log.debug("[ENT %s] Logging in with %s", url, username)
 
     # ENT Connection
-    session = requests.Session()
-    response = session.get(url, headers=HEADERS)
-
-    soup = BeautifulSoup(response.text, "html.parser")
-    form = soup.find("form", form_attr)
-    payload = {}
-    for input_ in form.findAll("input"):
-        payload[input_["name"]] = input_.get("value")
-    payload["username"] = username
-    payload["password"] = password
-
-    session.post(response.url, data=payload, headers=HEADERS)
+    session = _new_session()
+    _scrape_form_and_post(session, url, form_attr or {}, username, password)
 
     return session.cookies